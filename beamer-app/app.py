@@ -1,47 +1,75 @@
 #TTT
+import functools
 import os
 import pwd
 import subprocess
 import json
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, redirect, url_for, jsonify
 
+# orjson is optional; fall back to the stdlib codec when it isn't installed.
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
 app = Flask(__name__)
 
 AUTHORIZED_KEYS_FILE = "/root/.ssh/authorized_keys"
 SSH_DIR = os.path.dirname(AUTHORIZED_KEYS_FILE)
 TUNNEL_USER = "root"
+# Public key prefixes accepted by the /add form.
+ACCEPTED_KEY_PREFIXES = ("ssh-rsa", "ssh-ed25519", "ecdsa-sha2-")
 # Save persistent data to /data, which will be a mounted volume.
 DATA_DIR = "/data"
 EXPORTED_DEVICES_FILE = os.path.join(DATA_DIR, "exported_devices.json")
+# How long a 'usbip list' result is reused before querying again.
+USB_DEVICES_CACHE_TTL = 1.5
+# Upper bound on concurrent bind/unbind operations.
+USBIP_MAX_WORKERS = 8
+# Devices bound for export show up as <busid> links in this sysfs driver directory.
+USBIP_HOST_DRIVER_DIR = "/sys/bus/usb/drivers/usbip-host"
+SYSFS_USB_DEVICES_DIR = "/sys/bus/usb/devices"
+SYSFS_USB_DRIVERS_PROBE = "/sys/bus/usb/drivers_probe"
+BUSID_RE = re.compile(r"\d+-[\d.]+")
+# Matches a ' - busid <id> (...)' header line and the description line below it.
+USB_DEVICE_RE = re.compile(r"^[ \t]*\S+[ \t]+busid[ \t]+(\S+)[^\n]*(?:\n[ \t]*([^\n]*\S))?", re.M)
+
+_usb_cache = {"t": 0.0, "v": None}
+_usb_cache_lock = threading.Lock()
+
+def invalidate_usb_devices_cache():
+    """Forces the next get_usb_devices() call to re-query 'usbip'."""
+    with _usb_cache_lock:
+        _usb_cache["v"] = None
 
 def get_usb_devices():
-    """Fetches list of local USB devices using 'usbip'."""
+    """Fetches list of local USB devices using 'usbip', cached for a short TTL."""
+    with _usb_cache_lock:
+        if _usb_cache["v"] is not None and time.monotonic() - _usb_cache["t"] < USB_DEVICES_CACHE_TTL:
+            return _usb_cache["v"]
     try:
         result = subprocess.run(
             ["usbip", "list", "-l", "-p"],
             capture_output=True, text=True, check=True
         )
-        devices = []
-        # Split the output by blank lines to process each device block.
-        for device_block in result.stdout.strip().split('\n\n'):
-            if not device_block:
-                continue
-            
-            lines = device_block.strip().splitlines()
-            if not lines:
-                continue
-
-            first_line_parts = lines[0].split()
-            if len(first_line_parts) >= 3 and first_line_parts[1] == 'busid':
-                busid = first_line_parts[2]
-                
-                info = "Unknown Device"
-                if len(lines) > 1:
-                    info = lines[1].strip()
-                
-                devices.append({"busid": busid, "info": f"{info} ({busid})"})
+        devices = [
+            {"busid": m.group(1), "info": f"{m.group(2) or 'Unknown Device'} ({m.group(1)})"}
+            for m in USB_DEVICE_RE.finditer(result.stdout)
+        ]
 
         app.logger.info(f"Discovered USB devices: {devices}")
+        with _usb_cache_lock:
+            _usb_cache["t"] = time.monotonic()
+            _usb_cache["v"] = devices
         return devices
         
     except (FileNotFoundError, subprocess.CalledProcessError) as e:
@@ -50,62 +78,177 @@ def get_usb_devices():
 
 def get_exported_busids():
     """Loads the list of persistently exported device bus IDs."""
-    if not os.path.exists(EXPORTED_DEVICES_FILE):
-        return []
     try:
-        with open(EXPORTED_DEVICES_FILE, "r") as f:
-            return json.load(f)
+        with open(EXPORTED_DEVICES_FILE, "rb") as f:
+            return _json_loads(f.read())
     except (json.JSONDecodeError, FileNotFoundError):
         return [] # Return empty list if file is corrupt, empty, or not found.
 
-def set_exported_devices(new_busids):
-    """Binds/unbinds devices to match the new list, forcing a re-bind."""
-    current_busids = set(get_exported_busids())
-    new_busids = set(new_busids)
+def _sysfs_write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+def _sysfs_reprobe(busid):
+    """Asks the USB bus to attach a driverless device to a matching driver again."""
+    try:
+        _sysfs_write(SYSFS_USB_DRIVERS_PROBE, busid)
+    except OSError as e:
+        app.logger.error(f"Could not re-probe {busid}; it is left without a driver: {e}")
+
+def _sysfs_bind(busid):
+    """Binds a device to usbip-host via sysfs, mirroring what 'usbip bind' does."""
+    device_dir = os.path.join(SYSFS_USB_DEVICES_DIR, busid)
+    with open(os.path.join(device_dir, "bDeviceClass")) as f:
+        if f.read().strip() == "09":
+            # usbip-host refuses hubs; don't detach one from its driver for nothing.
+            raise OSError(f"{busid} is a USB hub")
+
+    # Detach the device from its current driver, if it has one.
+    try:
+        _sysfs_write(os.path.join(device_dir, "driver", "unbind"), busid)
+    except FileNotFoundError:
+        pass
 
-    # Unbind devices that are no longer selected
-    for busid in current_busids - new_busids:
+    match_busid = os.path.join(USBIP_HOST_DRIVER_DIR, "match_busid")
+    try:
+        _sysfs_write(match_busid, f"add {busid}")
         try:
-            # We don't check for errors here, as the device might not be bound.
-            subprocess.run(["usbip", "unbind", "-b", busid], check=False, capture_output=True)
-            app.logger.info(f"Unbound deselected device {busid}")
-        except Exception as e:
-            app.logger.error(f"An error occurred while unbinding {busid}: {e}")
-
-    # For every selected device, force a re-bind to ensure a fresh connection state.
-    for busid in new_busids:
-        # 1. Unbind first to clear any stale state. This is allowed to fail if not bound.
-        subprocess.run(["usbip", "unbind", "-b", busid], check=False, capture_output=True)
-        
-        # 2. Now, bind the device. This is expected to succeed.
+            _sysfs_write(os.path.join(USBIP_HOST_DRIVER_DIR, "bind"), busid)
+        except OSError:
+            _sysfs_write(match_busid, f"del {busid}")
+            raise
+    except OSError:
+        # The device is already detached; hand it back to its driver before giving up.
+        _sysfs_reprobe(busid)
+        raise
+
+def _sysfs_unbind(busid):
+    """Releases a device from usbip-host via sysfs, mirroring what 'usbip unbind' does.
+
+    Only the initial unbind write raises; once the device has left usbip-host
+    the usbip CLI can no longer help, so later failures are handled here.
+    """
+    if not os.path.exists(os.path.join(USBIP_HOST_DRIVER_DIR, busid)):
+        return # Not bound to usbip-host; nothing to do.
+    _sysfs_write(os.path.join(USBIP_HOST_DRIVER_DIR, "unbind"), busid)
+
+    try:
+        _sysfs_write(os.path.join(USBIP_HOST_DRIVER_DIR, "match_busid"), f"del {busid}")
+    except OSError as e:
+        app.logger.error(f"Failed to remove {busid} from usbip-host match_busid: {e}")
+    # Let the original driver claim the device again.
+    try:
+        _sysfs_write(os.path.join(USBIP_HOST_DRIVER_DIR, "rebind"), busid)
+    except OSError:
+        # Older kernels lack 'rebind'; probe the device through the bus instead.
+        _sysfs_reprobe(busid)
+
+def _usbip_bind(busid):
+    """Binds a device for export; raises CalledProcessError if the usbip fallback fails."""
+    if BUSID_RE.fullmatch(busid) and os.path.isdir(USBIP_HOST_DRIVER_DIR):
         try:
-            bind_result = subprocess.run(["usbip", "bind", "-b", busid], check=True, capture_output=True, text=True)
-            app.logger.info(f"Successfully bound device {busid}")
-        except subprocess.CalledProcessError as e:
-            app.logger.error(f"Failed to bind {busid} after unbind: {e.stderr.strip()}")
-    
+            _sysfs_bind(busid)
+            return
+        except OSError as e:
+            app.logger.warning(f"sysfs bind of {busid} failed, falling back to usbip: {e}")
+    subprocess.run(["usbip", "bind", "-b", busid], check=True, capture_output=True, text=True)
+
+def _usbip_unbind(busid):
+    """Unbinds a device from export. This is allowed to fail if not bound."""
+    if BUSID_RE.fullmatch(busid) and os.path.isdir(USBIP_HOST_DRIVER_DIR):
+        try:
+            _sysfs_unbind(busid)
+            return
+        except OSError as e:
+            app.logger.warning(f"sysfs unbind of {busid} failed, falling back to usbip: {e}")
+    subprocess.run(["usbip", "unbind", "-b", busid], check=False, capture_output=True)
+
+def _unbind_one(busid):
+    """Unbinds a device that is no longer selected for export."""
+    try:
+        # We don't check for errors here, as the device might not be bound.
+        _usbip_unbind(busid)
+        app.logger.info(f"Unbound deselected device {busid}")
+    except Exception as e:
+        app.logger.error(f"An error occurred while unbinding {busid}: {e}")
+
+def _rebind_one(busid):
+    """Forces a re-bind of a device to ensure a fresh connection state."""
+    # 1. Unbind first to clear any stale state. This is allowed to fail if not bound.
+    _usbip_unbind(busid)
+
+    # 2. Now, bind the device. This is expected to succeed.
+    try:
+        _usbip_bind(busid)
+        app.logger.info(f"Successfully bound device {busid}")
+    except subprocess.CalledProcessError as e:
+        app.logger.error(f"Failed to bind {busid} after unbind: {e.stderr.strip()}")
+
+def _currently_bound():
+    """Returns the bus IDs currently bound to the usbip-host driver."""
+    try:
+        return {name for name in os.listdir(USBIP_HOST_DRIVER_DIR) if BUSID_RE.fullmatch(name)}
+    except OSError:
+        return set() # Driver not loaded; nothing is bound.
+
+def set_exported_devices(new_busids, force=True):
+    """Binds/unbinds devices to match the new list.
+
+    With force=True every selected device is re-bound; otherwise devices
+    already bound to usbip-host are left as they are.
+    """
+    current_busids = set(get_exported_busids())
+    new_busids = set(new_busids)
+    to_rebind = new_busids if force else new_busids - _currently_bound()
+
+    # Each device is independent, so run the bind/unbind calls concurrently.
+    with ThreadPoolExecutor(max_workers=USBIP_MAX_WORKERS) as executor:
+        # Unbind devices that are no longer selected
+        list(executor.map(_unbind_one, current_busids - new_busids))
+        # For every selected device, force a re-bind.
+        list(executor.map(_rebind_one, to_rebind))
+
     # Ensure data directory exists before trying to save the file.
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    # Persist the new list via a temp file + rename, so an interrupted
+    # write never leaves a truncated file behind.
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".exported_devices.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_json_dumps(list(new_busids)))
+            # mkstemp creates the file 0600; keep the file's usual 0644 mode.
+            os.fchmod(f.fileno(), 0o644)
+            # Flush to disk before the rename so a power cut can't leave an empty file.
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, EXPORTED_DEVICES_FILE)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    # Binding changes the device state, so don't serve a stale listing.
+    invalidate_usb_devices_cache()
 
-    # Persist the new list
-    with open(EXPORTED_DEVICES_FILE, "w") as f:
-        json.dump(list(new_busids), f)
+@functools.lru_cache(maxsize=None)
+def _pw(user):
+    """Looks up a user's passwd entry once; NSS lookups can be slow."""
+    return pwd.getpwnam(user)
 
 def set_proper_permissions():
     """Ensures the .ssh directory and key file have correct ownership and permissions."""
     try:
-        root_uid = pwd.getpwnam(TUNNEL_USER).pw_uid
-        root_gid = pwd.getpwnam(TUNNEL_USER).pw_gid
+        tunnel_pw = _pw(TUNNEL_USER)
+        root_uid = tunnel_pw.pw_uid
+        root_gid = tunnel_pw.pw_gid
         
-        if not os.path.exists(SSH_DIR):
-            os.makedirs(SSH_DIR)
+        os.makedirs(SSH_DIR, exist_ok=True)
 
         os.chown(SSH_DIR, root_uid, root_gid)
         os.chmod(SSH_DIR, 0o700)
         
-        if not os.path.exists(AUTHORIZED_KEYS_FILE):
-            open(AUTHORIZED_KEYS_FILE, 'a').close()
+        # Appending creates the file if missing and leaves existing keys intact.
+        open(AUTHORIZED_KEYS_FILE, 'a').close()
 
         os.chown(AUTHORIZED_KEYS_FILE, root_uid, root_gid)
         os.chmod(AUTHORIZED_KEYS_FILE, 0o600)
@@ -113,12 +256,19 @@ def set_proper_permissions():
     except Exception as e:
         app.logger.error(f"Failed to set permissions: {e}")
 
+def init_app():
+    """Applies one-time startup state; run once per boot, before serving requests."""
+    # Set permissions on startup to guarantee correctness.
+    set_proper_permissions()
+    # On startup, re-apply the binding for persisted devices that lost it
+    set_exported_devices(get_exported_busids(), force=False)
+
 @app.route("/", methods=["GET"])
 def index():
     """Displays the current list of authorized keys and a form to add new ones."""
     try:
         with open(AUTHORIZED_KEYS_FILE, "r") as f:
-            keys = f.readlines()
+            keys = f.read().splitlines()
     except FileNotFoundError:
         keys = []
     
@@ -138,7 +288,7 @@ def export_devices():
 def add_key():
     """Adds a new public key and fixes permissions."""
     key = request.form.get("key", "").strip()
-    if key and (key.startswith("ssh-rsa") or key.startswith("ssh-ed25519")):
+    if key and key.startswith(ACCEPTED_KEY_PREFIXES):
         with open(AUTHORIZED_KEYS_FILE, "a") as f:
             f.write(key + "\n")
         set_proper_permissions()
@@ -150,11 +300,9 @@ def api_exported_devices():
     return jsonify(get_exported_busids())
 
 if __name__ == "__main__":
-    # Set permissions on startup to guarantee correctness.
-    set_proper_permissions()
-    # On startup, re-apply the binding for persisted devices
-    set_exported_devices(get_exported_busids())
+    # Standalone fallback; production runs under gunicorn (see gunicorn.conf.py).
+    init_app()
 
     # Use environment variable for port, default to 5000
     port = int(os.environ.get("APP_PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True) 
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port, debug=False) 
\ No newline at end of file
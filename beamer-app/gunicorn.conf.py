@@ -0,0 +1,13 @@
+"""Gunicorn settings for the Beamer web app."""
+import os
+
+# Use environment variable for port, default to 5000
+bind = f"0.0.0.0:{os.environ.get('APP_PORT', 5000)}"
+workers = 2
+worker_class = "gthread"
+threads = 8
+
+def on_starting(server):
+    """Runs the one-time startup in the master, before any worker forks."""
+    from app import init_app
+    init_app()
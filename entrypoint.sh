@@ -19,6 +19,7 @@ avahi-publish-service beamer-server _usbip._tcp ${TUNNEL_PORT} "USB Beamer Serve
 
 echo "All background services started."
 
-# Use exec to replace the shell with the Python process.
-# This ensures that the Flask app becomes PID 1 and handles signals correctly.
-exec python3 /app/app.py 
\ No newline at end of file
+# Use exec to replace the shell with the gunicorn master process.
+# This ensures that the web app becomes PID 1 and handles signals correctly.
+# Startup work (permissions, device re-binding) runs once in gunicorn's on_starting hook.
+exec gunicorn --chdir /app -c /app/gunicorn.conf.py app:app 
\ No newline at end of file